@@ -3,7 +3,7 @@
 
 import os
 from unittest import TestCase
-from llama.tokenizer import ChatFormat, Tokenizer
+from llama.tokenizer import ChatFormat, IncrementalDialogEncoder, Tokenizer
 
 # TOKENIZER_PATH=<path> python -m unittest llama/test_tokenizer.py
 
@@ -28,6 +28,58 @@ class TokenizerTests(TestCase):
             [128000, 2028, 374, 264, 1296, 11914, 13, 128001],
         )
 
+    def test_encode_cached(self):
+        s = "This is a test sentence."
+        self.tokenizer._encode_cache.clear()
+        self.assertEqual(
+            self.tokenizer.encode(s, bos=True, eos=True),
+            [128000, 2028, 374, 264, 1296, 11914, 13, 128001],
+        )
+        # The cached tokens exclude BOS/EOS, which are applied on every call.
+        self.assertEqual(
+            self.tokenizer._encode_cache[s], (2028, 374, 264, 1296, 11914, 13)
+        )
+        self.assertEqual(
+            self.tokenizer.encode(s, bos=False, eos=False),
+            [2028, 374, 264, 1296, 11914, 13],
+        )
+        self.assertEqual(
+            self.tokenizer.encode(s, bos=True, eos=False),
+            [128000, 2028, 374, 264, 1296, 11914, 13],
+        )
+
+    def test_encode_parallel(self):
+        # Several 100K-character chunks and over-long whitespace runs, so the
+        # input is split into many substrings encoded on the thread pool.
+        s = (
+            "This is a test sentence. " * 6000
+            + " " * 12000
+            + "<|eot_id|>This is a response.\n" * 4000
+            + "\n" * 12000
+        )
+        self.assertGreaterEqual(len(s), self.tokenizer.parallel_encode_min_chars)
+        specials = (set(), "all")
+        parallel = [
+            self.tokenizer.encode(s, bos=True, eos=True, allowed_special=special)
+            for special in specials
+        ]
+        self.tokenizer.parallel_encode_min_chars = len(s) + 1
+        serial = [
+            self.tokenizer.encode(s, bos=True, eos=True, allowed_special=special)
+            for special in specials
+        ]
+        self.assertEqual(parallel, serial)
+        for tokens in parallel:
+            self.assertEqual(tokens[0], 128000)  # <|begin_of_text|>
+            self.assertEqual(tokens[-1], 128001)  # <|end_of_text|>
+        # Only allowed_special="all" encodes the literal as <|eot_id|>.
+        self.assertNotIn(128009, parallel[0])
+        self.assertIn(128009, parallel[1])
+
+    def test_encode_too_long(self):
+        with self.assertRaises(ValueError):
+            self.tokenizer.encode("a" * 11, bos=False, eos=False, max_chars=10)
+
     def test_decode(self):
         self.assertEqual(
             self.tokenizer.decode(
@@ -86,3 +138,82 @@ class TokenizerTests(TestCase):
                 271,     # "\n\n"
             ]
         )
+
+    def test_incremental_dialog_encoder(self):
+        dialog = [
+            {
+                "role": "system",
+                "content": "This is a test sentence.",
+            },
+            {
+                "role": "user",
+                "content": "This is a response.",
+            }
+        ]
+        encoder = IncrementalDialogEncoder(self.tokenizer)
+        for i, message in enumerate(dialog):
+            encoder.append_message(message)
+            self.assertEqual(
+                encoder.tokens(),
+                self.format.encode_dialog_prompt(dialog[: i + 1]),
+            )
+
+    def test_incremental_dialog_encoder_eos(self):
+        encoder = IncrementalDialogEncoder(self.tokenizer)
+        encoder.append_message({"role": "user", "content": "This is a test sentence."})
+        self.assertEqual(
+            encoder.tokens(eos=True),
+            [
+                128000,  # <|begin_of_text|>
+                128006,  # <|start_header_id|>
+                882,     # "user"
+                128007,  # <|end_of_header|>
+                271,     # "\n\n"
+                2028, 374, 264, 1296, 11914, 13,  # "This is a test sentence."
+                128009,  # <|eot_id|>
+                128001,  # <|end_of_text|>
+            ]
+        )
+
+    def test_incremental_dialog_encoder_continues_assistant(self):
+        encoder = IncrementalDialogEncoder(self.tokenizer)
+        encoder.append_message({"role": "user", "content": "This is a test sentence."})
+        encoder.append_message({"role": "assistant", "content": "This is a response."})
+        self.assertEqual(
+            encoder.tokens(),
+            [
+                128000,  # <|begin_of_text|>
+                128006,  # <|start_header_id|>
+                882,     # "user"
+                128007,  # <|end_of_header|>
+                271,     # "\n\n"
+                2028, 374, 264, 1296, 11914, 13,  # "This is a test sentence."
+                128009,  # <|eot_id|>
+                128006,  # <|start_header_id|>
+                78191,   # "assistant"
+                128007,  # <|end_of_header|>
+                271,     # "\n\n"
+                2028, 374, 264, 2077, 13,  # "This is a response."
+            ]
+        )
+
+
+class SplitWhitespacesTests(TestCase):
+    def split(self, s, max_len):
+        return list(Tokenizer._split_whitespaces_or_nonwhitespaces(s, max_len))
+
+    def test_long_runs_are_cut(self):
+        self.assertEqual(self.split("aaaa  bb", 2), ["aa", "aa  bb"])
+        self.assertEqual(self.split("a   b", 2), ["a  ", " b"])
+        self.assertEqual(self.split("aaaaa", 2), ["aa", "aa", "a"])
+
+    def test_short_runs_stay_together(self):
+        self.assertEqual(self.split("ab cd\nef", 2), ["ab cd\nef"])
+        self.assertEqual(self.split("ab cd  ef", 3), ["ab cd  ef"])
+
+    def test_unicode_whitespace(self):
+        # "\x1c" and "\x85" are whitespace according to `str.isspace`.
+        self.assertEqual(self.split("a\x1c\x85\x1cb", 2), ["a\x1c\x85", "\x1cb"])
+
+    def test_empty(self):
+        self.assertEqual(self.split("", 2), [""])
@@ -2,8 +2,11 @@
 # This software may be used and distributed in accordance with the terms of the Llama 3 Community License Agreement.
 
 import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from logging import getLogger
-from pathlib import Path
 from typing import (
     AbstractSet,
     cast,
@@ -12,14 +15,13 @@ from typing import (
     Iterator,
     List,
     Literal,
+    Optional,
     Sequence,
+    Tuple,
     TypedDict,
     Union,
 )
 
-import tiktoken
-from tiktoken.load import load_tiktoken_bpe
-
 
 logger = getLogger(__name__)
 
@@ -34,6 +36,34 @@ class Message(TypedDict):
 
 Dialog = Sequence[Message]
 
+# Maximal runs of whitespace or non-whitespace characters. `\s` uses the same
+# definition of whitespace as `str.isspace`.
+_RUN_RE = re.compile(r"\s+|\S+")
+
+# tiktoken releases the GIL while encoding, so the substrings of large inputs
+# can be encoded concurrently. The pool is created on first use and dropped in
+# forked children, whose copy would have no worker threads behind it.
+_encode_executor: Optional[ThreadPoolExecutor] = None
+_encode_executor_lock = threading.Lock()
+
+
+def _get_encode_executor() -> ThreadPoolExecutor:
+    global _encode_executor
+    with _encode_executor_lock:
+        if _encode_executor is None:
+            _encode_executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+        return _encode_executor
+
+
+def _reset_encode_executor() -> None:
+    global _encode_executor, _encode_executor_lock
+    _encode_executor = None
+    _encode_executor_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_encode_executor)
+
 
 class Tokenizer:
     """
@@ -44,6 +74,19 @@ class Tokenizer:
 
     num_reserved_special_tokens = 256
 
+    # Short strings (roles, separators, short turns) are encoded over and over
+    # again; keep their token IDs around instead of going through tiktoken.
+    encode_cache_size = 4096
+    encode_cache_max_chars = 128
+
+    # tiktoken's encoding time grows superlinearly with input length; inputs
+    # longer than this are rejected before any of it is spent.
+    max_total_chars = 2_000_000
+
+    # Inputs at least this long that split into several substrings are
+    # encoded on a shared thread pool; below it the pool overhead isn't worth it.
+    parallel_encode_min_chars = 200_000
+
     pat_str = r"(?i:'s|'t|'re|'ve|'m|'ll|'d)|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+"  # noqa: E501
 
     def __init__(self, model_path: str):
@@ -53,6 +96,11 @@ class Tokenizer:
         Args:
             model_path (str): The path to the Tiktoken model file.
         """
+        # Imported here so that the module (e.g. the Message/Dialog types) can
+        # be used without loading tiktoken.
+        import tiktoken
+        from tiktoken.load import load_tiktoken_bpe
+
         assert os.path.isfile(model_path), model_path
 
         mergeable_ranks = load_tiktoken_bpe(model_path)
@@ -76,7 +124,7 @@ class Tokenizer:
             token: num_base_tokens + i for i, token in enumerate(special_tokens)
         }
         self.model = tiktoken.Encoding(
-            name=Path(model_path).name,
+            name=os.path.basename(model_path),
             pat_str=self.pat_str,
             mergeable_ranks=mergeable_ranks,
             special_tokens=self.special_tokens,
@@ -88,13 +136,15 @@ class Tokenizer:
         self.bos_id: int = self.special_tokens["<|begin_of_text|>"]
         self.eos_id: int = self.special_tokens["<|end_of_text|>"]
         self.pad_id: int = -1
-        self.stop_tokens = {
-            self.special_tokens["<|end_of_text|>"],
-            self.special_tokens["<|eot_id|>"],
-        }
+        # Chat format token IDs
+        self.start_header_id: int = self.special_tokens["<|start_header_id|>"]
+        self.end_header_id: int = self.special_tokens["<|end_header_id|>"]
+        self.eot_id: int = self.special_tokens["<|eot_id|>"]
+        self.stop_tokens = frozenset({self.eos_id, self.eot_id})
         logger.info(
             f"#words: {self.n_words} - BOS ID: {self.bos_id} - EOS ID: {self.eos_id}"
         )
+        self._encode_cache: Dict[str, Tuple[int, ...]] = {}
 
     def encode(
         self,
@@ -104,6 +154,7 @@ class Tokenizer:
         eos: bool,
         allowed_special: Union[Literal["all"], AbstractSet[str]] = set(),
         disallowed_special: Union[Literal["all"], Collection[str]] = (),
+        max_chars: Optional[int] = None,
     ) -> List[int]:
         """
         Encodes a string into a list of token IDs.
@@ -114,10 +165,15 @@ class Tokenizer:
             eos (bool): Whether to append the end-of-sequence token.
             allowed_tokens ("all"|set[str]): allowed special tokens in string
             disallowed_tokens ("all"|set[str]): special tokens that raise an error when in string
+            max_chars (int, optional): Maximum accepted length of `s` in characters.
+                Defaults to `max_total_chars`.
 
         Returns:
             list[int]: A list of token IDs.
 
+        Raises:
+            ValueError: If `s` is longer than `max_chars`.
+
         By default, setting disallowed_special=() encodes a string by ignoring
         special tokens. Specifically:
         - Setting `disallowed_special` to () will cause all text corresponding
@@ -128,33 +184,67 @@ class Tokenizer:
         """
         assert type(s) is str
 
+        if max_chars is None:
+            max_chars = self.max_total_chars
+        if len(s) > max_chars:
+            raise ValueError(
+                f"Input of {len(s)} characters exceeds the limit of {max_chars}"
+            )
+
         # The tiktoken tokenizer can handle <=400k chars without
-        # pyo3_runtime.PanicException.
-        TIKTOKEN_MAX_ENCODE_CHARS = 400_000
+        # pyo3_runtime.PanicException, but its runtime is superlinear well
+        # before that, so keep chunks smaller.
+        TIKTOKEN_MAX_ENCODE_CHARS = 100_000
 
         # https://github.com/openai/tiktoken/issues/195
         # Here we iterate over subsequences and split if we exceed the limit
         # of max consecutive non-whitespace or whitespace characters.
-        MAX_NO_WHITESPACES_CHARS = 25_000
-
-        substrs = (
-            substr
-            for i in range(0, len(s), TIKTOKEN_MAX_ENCODE_CHARS)
-            for substr in self._split_whitespaces_or_nonwhitespaces(
-                s[i : i + TIKTOKEN_MAX_ENCODE_CHARS], MAX_NO_WHITESPACES_CHARS
-            )
-        )
-        t: List[int] = []
-        for substr in substrs:
-            t.extend(
-                self.model.encode(
-                    substr,
+        MAX_NO_WHITESPACES_CHARS = 10_000
+
+        # With the default arguments special tokens are encoded as natural text.
+        default_special = allowed_special == set() and disallowed_special == ()
+        # Only the default special-token handling is cached, so the cache key
+        # can be the string alone.
+        use_cache = default_special and len(s) < self.encode_cache_max_chars
+        t: List[int] = [self.bos_id] if bos else []
+        cached = self._encode_cache.get(s) if use_cache else None
+        if cached is not None:
+            t.extend(cached)
+        else:
+            substrs = [
+                substr
+                for i in range(0, len(s), TIKTOKEN_MAX_ENCODE_CHARS)
+                for substr in self._split_whitespaces_or_nonwhitespaces(
+                    s[i : i + TIKTOKEN_MAX_ENCODE_CHARS], MAX_NO_WHITESPACES_CHARS
+                )
+            ]
+            if default_special:
+                # Skips tiktoken's special-token checks entirely.
+                encode_substr = self.model.encode_ordinary
+            else:
+                encode_substr = partial(
+                    self.model.encode,
                     allowed_special=allowed_special,
                     disallowed_special=disallowed_special,
                 )
-            )
-        if bos:
-            t.insert(0, self.bos_id)
+            if len(substrs) >= 2 and len(s) >= self.parallel_encode_min_chars:
+                # `map` yields results in submission order.
+                pieces = _get_encode_executor().map(encode_substr, substrs)
+            else:
+                pieces = map(encode_substr, substrs)
+            for piece in pieces:
+                t.extend(piece)
+            if use_cache:
+                if len(self._encode_cache) >= self.encode_cache_size:
+                    # Evict the oldest entry (dicts preserve insertion order).
+                    # Tolerates another thread evicting the same entry first.
+                    try:
+                        oldest = next(iter(self._encode_cache))
+                    except RuntimeError:  # resized by another thread
+                        oldest = None
+                    if oldest is not None:
+                        self._encode_cache.pop(oldest, None)
+                self._encode_cache[s] = tuple(t[1:] if bos else t)
         if eos:
             t.append(self.eos_id)
         return t
@@ -180,50 +270,123 @@ class Tokenizer:
         Splits the string `s` so that each substring contains no more than `max_consecutive_slice_len`
         consecutive whitespaces or consecutive non-whitespaces.
         """
-        current_slice_len = 0
-        current_slice_is_space = s[0].isspace() if len(s) > 0 else False
-        slice_start = 0
-
-        for i in range(len(s)):
-            is_now_space = s[i].isspace()
+        if len(s) <= max_consecutive_slice_len:
+            # No run can exceed the limit, so there is nothing to scan for.
+            yield s
+            return
 
-            if current_slice_is_space ^ is_now_space:
-                current_slice_len = 1
-                current_slice_is_space = is_now_space
-            else:
-                current_slice_len += 1
-                if current_slice_len > max_consecutive_slice_len:
-                    yield s[slice_start:i]
-                    slice_start = i
-                    current_slice_len = 1
+        slice_start = 0
+        for match in _RUN_RE.finditer(s):
+            start, end = match.span()
+            # Only runs longer than the limit need to be cut, every
+            # `max_consecutive_slice_len` characters from the start of the run.
+            for i in range(
+                start + max_consecutive_slice_len, end, max_consecutive_slice_len
+            ):
+                yield s[slice_start:i]
+                slice_start = i
         yield s[slice_start:]
 
 
 class ChatFormat:
     def __init__(self, tokenizer: Tokenizer):
         self.tokenizer = tokenizer
+        self._bos_id = tokenizer.bos_id
+        self._start_header_id = tokenizer.start_header_id
+        self._end_header_id = tokenizer.end_header_id
+        self._eot_id = tokenizer.eot_id
+        # The header separator is a fixed literal; encode it once up front.
+        self._double_newline_tokens: Tuple[int, ...] = tuple(
+            self.tokenizer.encode("\n\n", bos=False, eos=False)
+        )
+        # Header tokens only depend on the role, of which there are three.
+        self._header_cache: Dict[str, Tuple[int, ...]] = {}
 
     def encode_header(self, message: Message) -> List[int]:
-        tokens = []
-        tokens.append(self.tokenizer.special_tokens["<|start_header_id|>"])
-        tokens.extend(self.tokenizer.encode(message["role"], bos=False, eos=False))
-        tokens.append(self.tokenizer.special_tokens["<|end_header_id|>"])
-        tokens.extend(self.tokenizer.encode("\n\n", bos=False, eos=False))
+        tokens: List[int] = []
+        self._append_header(tokens, message)
         return tokens
 
     def encode_message(self, message: Message) -> List[int]:
-        tokens = self.encode_header(message)
-        tokens.extend(
-            self.tokenizer.encode(message["content"].strip(), bos=False, eos=False)
-        )
-        tokens.append(self.tokenizer.special_tokens["<|eot_id|>"])
+        tokens: List[int] = []
+        self._append_message(tokens, message)
         return tokens
 
     def encode_dialog_prompt(self, dialog: Dialog) -> List[int]:
-        tokens = []
-        tokens.append(self.tokenizer.special_tokens["<|begin_of_text|>"])
+        tokens = [self._bos_id]
         for message in dialog:
-            tokens.extend(self.encode_message(message))
+            self._append_message(tokens, message)
         # Add the start of an assistant message for the model to complete.
-        tokens.extend(self.encode_header({"role": "assistant", "content": ""}))
+        self._append_header(tokens, {"role": "assistant", "content": ""})
+        return tokens
+
+    # The helpers below append to a caller-provided list so that a whole dialog
+    # is encoded into one buffer without intermediate per-message lists.
+
+    def _append_header(self, tokens: List[int], message: Message) -> None:
+        role = message["role"]
+        header = self._header_cache.get(role)
+        if header is None:
+            header = (
+                self._start_header_id,
+                *self.tokenizer.encode(role, bos=False, eos=False),
+                self._end_header_id,
+                *self._double_newline_tokens,
+            )
+            self._header_cache[role] = header
+        tokens.extend(header)
+
+    def _append_message(self, tokens: List[int], message: Message) -> None:
+        self._append_header(tokens, message)
+        content = message["content"].strip()
+        if content:
+            tokens.extend(self.tokenizer.encode(content, bos=False, eos=False))
+        tokens.append(self._eot_id)
+
+
+class IncrementalDialogEncoder(ChatFormat):
+    """
+    Encodes a dialog one message at a time, keeping the tokens of the messages
+    seen so far so that each new turn only costs the encoding of that turn.
+    """
+
+    def __init__(self, tokenizer: Tokenizer):
+        super().__init__(tokenizer)
+        self._prefix: List[int] = [self._bos_id]
+        # While the last message is from the assistant, `tokens` leaves its
+        # turn open for the model by dropping the trailing <|eot_id|>.
+        self._last_is_assistant = False
+
+    def append_message(self, message: Message) -> None:
+        """
+        Appends a message to the dialog.
+
+        Args:
+            message (Message): The message to be encoded and appended.
+        """
+        self._append_message(self._prefix, message)
+        self._last_is_assistant = message["role"] == "assistant"
+
+    def tokens(self, eos: bool = False) -> List[int]:
+        """
+        Returns the tokens of the dialog so far.
+
+        Args:
+            eos (bool): Whether to close the dialog with the end-of-sequence token
+                instead of leaving it open for the model to complete.
+
+        Returns:
+            list[int]: With `eos`, all appended messages followed by the
+                end-of-sequence token. Otherwise, if the last message is from the
+                assistant, the dialog without its trailing <|eot_id|> so the model
+                continues that turn; else the same token IDs
+                `encode_dialog_prompt` returns, ending with the start of an
+                assistant message.
+        """
+        if eos:
+            return self._prefix + [self.tokenizer.eos_id]
+        if self._last_is_assistant:
+            return self._prefix[:-1]
+        tokens = list(self._prefix)
+        self._append_header(tokens, {"role": "assistant", "content": ""})
         return tokens